@@ -1,7 +1,14 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import time
 import random
+import numbers
 import os
+import threading
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
 from pytrends.request import TrendReq
 from io import StringIO
 from datetime import datetime
@@ -10,11 +17,14 @@ import logging
 # ==========================================
 # 1. CONFIGURATION
 # ==========================================
-YEAR = 2021, 2022, 2023, 2024
+YEAR = (2021, 2022, 2023, 2024)  # Every year to fetch, as ints
 SEARCH_TERMS = [
     "Fishing", "Bass Fishing", "Trout Fishing", "Fly Fishing", "Ice Fishing"
 ]
-OUTPUT_FILE = "trends_checkpoint.csv"
+OUTPUT_DIR = "trends_out"  # Parquet dataset, partitioned by year and geo_code
+OUTPUT_COLUMNS = [
+    "date", "latitude", "longitude", "country", "state", "search_count", "location", "geo_code", "search_term", "year"
+]
 LOG_FILE = "trends_scraper.log"
 MAX_CITIES_PER_RUN = 50  # Adjust this to process fewer cities per run if needed
 
@@ -39,101 +49,158 @@ logger.info(f"Loaded {len(df_cities)} cities from usa_cities.csv")
 # ==========================================
 
 def get_completed_cities():
-    """Reads the output file to see which geo_codes are already done."""
-    if not os.path.exists(OUTPUT_FILE):
-        logger.info("No checkpoint file found. Starting fresh.")
+    """Lists the geo_codes with a partition for every year in YEAR."""
+    if not os.path.isdir(OUTPUT_DIR):
+        logger.info("No checkpoint dataset found. Starting fresh.")
         return set()
-    
-    # Read just the columns we need to identify finished work
-    try:
-        df_done = pd.read_csv(OUTPUT_FILE)
-        if 'geo_code' in df_done.columns:
-            completed = set(df_done['geo_code'].unique())
-            logger.info(f"Found {len(completed)} completed cities in checkpoint file")
-            return completed
-    except pd.errors.EmptyDataError:
-        logger.warning("Checkpoint file is empty")
-        pass
-    
-    return set()
+
+    # Partition directories look like trends_out/year=2023/geo_code=US-NY-501,
+    # so finished work can be found without opening a single file.
+    # A city is only done once it has a partition under every year: an interrupted
+    # write can leave some years missing, and those cities must be fetched again.
+    geos_per_year = []
+    for year in YEAR:
+        year_path = os.path.join(OUTPUT_DIR, f'year={year}')
+        geos = set()
+        if os.path.isdir(year_path):
+            geos = {
+                unquote(name.split('=', 1)[1])
+                for name in os.listdir(year_path)
+                if name.startswith('geo_code=')
+            }
+        geos_per_year.append(geos)
+    completed = set.intersection(*geos_per_year)
+    logger.info(f"Found {len(completed)} completed cities in checkpoint dataset")
+    return completed
 
 # ==========================================
 # 3. GOOGLE TRENDS FUNCTION WITH RATE LIMIT HANDLING
 # ==========================================
-def fetch_city_trends(geo_code, keywords, year, max_retries=3):
+# One client for the whole run, so its session and cookies are reused across cities
+PYTRENDS = None
+
+def get_pytrends():
     """
-    Fetch Google Trends data. If data is empty, fill with Zeros.
+    Shared TrendReq client, created on first use. Its constructor fetches Google
+    cookies, so this runs inside the main loop's error handling, not at import.
     """
-    pytrends = TrendReq(hl='en-US', tz=360, timeout=(10,25))
-    timeframe = f'{year}-01-01 {year}-12-31'
-    all_data = []
+    global PYTRENDS
+    if PYTRENDS is None:
+        PYTRENDS = TrendReq(hl='en-US', tz=360, timeout=(10,25), retries=0)
+    return PYTRENDS
 
-    # Create a standard date range for the year (Weekly, Sunday-based)
-    # We use this to fill in blanks if Google returns nothing.
-    # Note: Google Trends standard is Sunday-ending weeks.
-    date_range = pd.date_range(start=f'{year}-01-01', end=f'{year}-12-31', freq='W-SUN')
+# TrendReq keeps the last payload on the client, so a build/fetch pair must not interleave
+PYTRENDS_LOCK = threading.Lock()
+MAX_KEYWORD_WORKERS = 2  # Google's per-IP limit is tight; only overlap the waits
 
-    for term in keywords:
-        print(f"    > Keyword: '{term}'", end=" ", flush=True)
-        
-        retry_count = 0
-        while retry_count < max_retries:
-            try:
-                # Sleep 15-30 seconds to look human
-                time.sleep(random.uniform(15, 30))
-                
+def _fetch_one_term(pytrends, term, geo_code, timeframe, date_range, max_retries=3):
+    """
+    Fetch one keyword for one city. Returns None if it could not be fetched.
+    """
+    retry_count = 0
+    while retry_count < max_retries:
+        try:
+            # Sleep 15-30 seconds to look human
+            time.sleep(random.uniform(15, 30))
+
+            with PYTRENDS_LOCK:
                 pytrends.build_payload([term], cat=0, timeframe=timeframe, geo=geo_code)
                 data = pytrends.interest_over_time()
-                
-                # --- LOGIC CHANGE HERE ---
-                if data.empty:
-                    print("⚠️ (Empty -> Saving as 0)")
-                    logger.warning(f"No data for '{term}' in {geo_code}. Filling with Zeros.")
-                    
-                    # Create a dummy dataframe with zeros
-                    data = pd.DataFrame({'date': date_range})
-                    data['search_count'] = 0
-                    data['search_term'] = term
-                    data['is_partial'] = list(data.iloc[:, 0] == False) # Dummy column to match structure if needed
-                else:
-                    data = data.reset_index()
-                    data = data.rename(columns={term: 'search_count', 'date': 'date'})
-                    data['search_term'] = term
-                    print("✅")
-                    logger.info(f"Fetched '{term}' in {geo_code}")
-
-                # Standardize columns
-                data = data[['date', 'search_term', 'search_count']]
-                all_data.append(data)
-                
-                break  # Success, exit retry loop
-                
-            except Exception as e:
-                # ... (Same error handling as before) ...
-                if "429" in str(e):
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        wait_time = (2 ** retry_count) * 60
-                        print(f"\n    ⏳ Rate limited. Waiting {wait_time/60:.1f} min...")
-                        time.sleep(wait_time)
-                    else:
-                        print(f"\n    ❌ Max retries. Skipping.")
-                        break
+
+            # --- LOGIC CHANGE HERE ---
+            if data.empty:
+                print(f"    > Keyword: '{term}' ⚠️ (Empty -> Saving as 0)")
+                logger.warning(f"No data for '{term}' in {geo_code}. Filling with Zeros.")
+
+                # Create a dummy dataframe with zeros
+                data = pd.DataFrame({'date': date_range, 'search_term': term, 'search_count': 0})
+            else:
+                data = data.reset_index()
+                data = data.rename(columns={term: 'search_count', 'date': 'date'})
+                data['search_term'] = term
+                print(f"    > Keyword: '{term}' ✅")
+                logger.info(f"Fetched '{term}' in {geo_code}")
+
+            # Standardize columns
+            return data[['date', 'search_term', 'search_count']]
+
+        except Exception as e:
+            # Back off only this keyword's worker; the other keeps going
+            if "429" in str(e):
+                retry_count += 1
+                if retry_count < max_retries:
+                    wait_time = (2 ** retry_count) * 60
+                    print(f"    ⏳ '{term}' rate limited. Waiting {wait_time/60:.1f} min...")
+                    time.sleep(wait_time)
+                    # Only a rate limit earns a fresh set of cookies
+                    with PYTRENDS_LOCK:
+                        try:
+                            pytrends.cookies = pytrends.GetGoogleCookie()
+                        except Exception as cookie_error:
+                            # Keep the old cookies; a failed refresh must not stop the run
+                            logger.warning(f"Cookie refresh failed, keeping old cookies: {cookie_error}")
                 else:
-                    print(f"\n    ❌ Error: {e}")
-                    time.sleep(5)
-                    break
+                    print(f"    ❌ '{term}' max retries. Skipping.")
+                    return None
+            else:
+                print(f"    ❌ '{term}' error: {e}")
+                time.sleep(5)
+                return None
+
+    return None
 
+def fetch_city_trends(geo_code, keywords, years, max_retries=3, pytrends=None):
+    """
+    Fetch Google Trends data. If data is empty, fill with Zeros.
+    One request per keyword spans the first to last of `years` (an iterable of ints,
+    e.g. YEAR); only rows dated in one of `years` are returned.
+
+    NOTE ON UNITS: Google scales search_count 0-100 over the whole requested span, so the
+    peak week across ALL of `years` is 100. Older per-year exports (data/trends_data/*.csv,
+    visualization/trends-with_weather_2023.csv) were scaled 0-100 within each year, so the
+    two are not directly comparable. Quiet cities also round to 0 more often over a
+    multi-year span.
+    """
+    # Reject anything but integer years instead of sending Google a malformed timeframe.
+    # Shape first (a bare 2023 isn't iterable), then each value; numpy ints are fine.
+    if not isinstance(years, Iterable):
+        raise ValueError(f"years must be an iterable of ints, got {years!r}")
+    years = list(years)
+    if not years or not all(isinstance(y, numbers.Integral) and not isinstance(y, bool) for y in years):
+        raise ValueError(f"years must be a non-empty iterable of ints, got {years!r}")
+    years = sorted({int(y) for y in years})
+    if pytrends is None:
+        pytrends = get_pytrends()
+    start, end = f'{min(years)}-01-01', f'{max(years)}-12-31'
+    timeframe = f'{start} {end}'
+
+    # Create a standard date range for the years (Weekly, Sunday-based)
+    # We use this to fill in blanks if Google returns nothing.
+    # Note: Google Trends standard is Sunday-ending weeks.
+    date_range = pd.date_range(start=start, end=end, freq='W-SUN')
+
+    # Keywords run side by side so their human-pacing sleeps overlap
+    with ThreadPoolExecutor(max_workers=MAX_KEYWORD_WORKERS) as ex:
+        futures = [
+            ex.submit(_fetch_one_term, pytrends, term, geo_code, timeframe, date_range, max_retries)
+            for term in keywords
+        ]
+        all_data = [f.result() for f in futures]
+
+    all_data = [data for data in all_data if data is not None]
     if not all_data:
         return pd.DataFrame()
-    return pd.concat(all_data, ignore_index=True)
+
+    # The span can include skipped years or the week holding Jan 1 of the prior year
+    df_all = pd.concat(all_data, ignore_index=True)
+    return df_all[df_all['date'].dt.year.isin(years)].reset_index(drop=True)
 
 # ==========================================
 # 4. MAIN LOOP
 # ==========================================
 
 logger.info("="*60)
-logger.info(f"Starting new scraping run for year {YEAR}")
+logger.info(f"Starting new scraping run for years {min(YEAR)}-{max(YEAR)}")
 logger.info(f"Search terms: {', '.join(SEARCH_TERMS)}")
 logger.info("="*60)
 
@@ -148,7 +215,7 @@ logger.info(f"Processing {len(cities_to_process)} cities in this run (max {MAX_C
 successful_cities = 0
 failed_cities = 0
 
-for index, row in cities_to_process.iterrows():
+for row in cities_to_process.to_dict('records'):
     city = row['location_name']
     geo = row['geo_code']
     
@@ -164,20 +231,28 @@ for index, row in cities_to_process.iterrows():
             df_trends['location'] = city
             df_trends['country'] = row['country']
             df_trends['state'] = row['state_province']
-            df_trends['year'] = YEAR
+            df_trends['year'] = df_trends['date'].dt.year
             df_trends['latitude'] = row['latitude']
             df_trends['longitude'] = row['longitude']
 
             # Reorder columns to match request
-            cols = ["date", "latitude", "longitude", "country", "state", "search_count", "location", "geo_code", "search_term", "year"]
-            df_trends = df_trends[cols]
+            df_trends = df_trends[OUTPUT_COLUMNS]
+
+            # Repeated text columns are stored dictionary-encoded, one copy per value
+            for c in ('search_term', 'geo_code', 'location', 'country', 'state'):
+                df_trends[c] = df_trends[c].astype('category')
             
-            # SAVE IMMEDIATELY (Append Mode)
-            # If file doesn't exist, write header. If it does, skip header.
-            write_header = not os.path.exists(OUTPUT_FILE)
-            df_trends.to_csv(OUTPUT_FILE, mode='a', header=write_header, index=False)
+            # SAVE IMMEDIATELY (adds new files under this city's partitions)
+            pq.write_to_dataset(
+                pa.Table.from_pandas(df_trends, preserve_index=False),
+                root_path=OUTPUT_DIR,
+                partition_cols=['year', 'geo_code'],
+                # Replace, don't append to, partitions left by an interrupted earlier attempt
+                existing_data_behavior='delete_matching'
+            )
             print(f"    💾 Saved data for {city}")
             logger.info(f"Successfully saved {len(df_trends)} rows for {city}")
+            completed_geos.add(geo)
             successful_cities += 1
         else:
             # If empty, we still want to mark it as 'done' so we don't retry forever?
@@ -197,12 +272,14 @@ for index, row in cities_to_process.iterrows():
         failed_cities += 1
         break
 
-print("\n✅ Run completed! Check trends_checkpoint.csv for results.")
+print(f"\n✅ Run completed! Check {OUTPUT_DIR}/ for results.")
 logger.info("="*60)
 logger.info(f"Run completed - Successful: {successful_cities}, Failed: {failed_cities}")
-print(f"📊 Total cities completed so far: {len(get_completed_cities())}")
-remaining = len(df_cities) - len(get_completed_cities())
+# completed_geos is kept up to date in the loop, so no need to re-read the checkpoint
+total_done = len(completed_geos)
+print(f"📊 Total cities completed so far: {total_done}")
+remaining = len(df_cities) - total_done
 print(f"🔄 Remaining cities: {remaining}")
-logger.info(f"Total progress: {len(get_completed_cities())}/{len(df_cities)} cities completed")
+logger.info(f"Total progress: {total_done}/{len(df_cities)} cities completed")
 logger.info(f"Remaining cities: {remaining}")
 logger.info("="*60)
@@ -1,8 +1,13 @@
+import asyncio
+import os
+import sys
 import pandas as pd
-import requests
-import time
 from io import StringIO
 
+# Shared Open-Meteo client (openmeteo_client.py) lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from openmeteo_client import MAX_CONCURRENT_REQUESTS, fetch_one, open_session
+
 # ---------------------------------------------------------
 # 1. SETUP & INPUT DATA
 # ---------------------------------------------------------
@@ -12,65 +17,56 @@ df = pd.read_csv('usa_cities.csv')
 # 2. DEFINE API FUNCTION
 # ---------------------------------------------------------
 
-def get_historical_weather(row):
-    url = "https://archive-api.open-meteo.com/v1/archive"
-    
+async def get_historical_weather(session, sem, row):
     # Requesting Mean, Max, Min, and Precipitation sum
     params = {
         "latitude": row['latitude'],
         "longitude": row['longitude'],
         "start_date": "2023-01-01",
         "end_date": "2023-12-31",
-        "daily": ["temperature_2m_mean", "temperature_2m_max", "temperature_2m_min", "precipitation_sum"],
+        "daily": "temperature_2m_mean,temperature_2m_max,temperature_2m_min,precipitation_sum",
         "timezone": "auto"
     }
 
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
+        print(f"Fetching {row['location_name']}...")
+        data = await fetch_one(session, sem, params)
         
         daily_data = data.get('daily', {})
         
-        # Extract lists
-        dates = daily_data.get('time', [])
-        means = daily_data.get('temperature_2m_mean', [])
-        maxs = daily_data.get('temperature_2m_max', [])
-        mins = daily_data.get('temperature_2m_min', [])
-        precips = daily_data.get('precipitation_sum', [])
-        
-        results = []
-        # Zip all lists together to iterate day by day
-        for date, mean_t, max_t, min_t, precip in zip(dates, means, maxs, mins, precips):
-            entry = row.to_dict()
-            entry['date'] = date
-            entry['temp_mean'] = mean_t
-            entry['temp_max'] = max_t
-            entry['temp_min'] = min_t
-            entry['precip_sum'] = precip
-            results.append(entry)
-            
-        return results
+        # Build the city's daily frame straight from the response lists
+        df_city = pd.DataFrame({
+            'date': daily_data.get('time', []),
+            'temp_mean': daily_data.get('temperature_2m_mean', []),
+            'temp_max': daily_data.get('temperature_2m_max', []),
+            'temp_min': daily_data.get('temperature_2m_min', []),
+            'precip_sum': daily_data.get('precipitation_sum', [])
+        })
+
+        # Scalar assignment broadcasts the city's metadata to every day
+        for col, value in row.items():
+            df_city[col] = value
+
+        return df_city
 
     except Exception as e:
         print(f"Error fetching data for {row['location_name']}: {e}")
-        return []
+        return pd.DataFrame()
+
+async def fetch_all(rows):
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with open_session() as session:
+        return await asyncio.gather(*(get_historical_weather(session, sem, row) for row in rows))
 
 # ---------------------------------------------------------
 # 3. FETCH DATA
 # ---------------------------------------------------------
 
 print("Starting API calls...")
-all_weather_data = []
-
-for index, row in df.iterrows():
-    print(f"Fetching {row['location_name']}...")
-    city_weather = get_historical_weather(row)
-    all_weather_data.extend(city_weather)
-    time.sleep(0.5) 
+city_frames = asyncio.run(fetch_all(df.to_dict('records')))
 
 # Create DataFrame of DAILY data
-daily_df = pd.DataFrame(all_weather_data)
+daily_df = pd.concat(city_frames, ignore_index=True)
 daily_df['date'] = pd.to_datetime(daily_df['date'])
 
 # ---------------------------------------------------------
@@ -89,13 +85,17 @@ agg_rules = {
     'precip_sum': 'sum'   # Total rainfall for the week
 }
 
+# Label each day with the Sunday that ends its week (same bins/labels as resample('W')),
+# so a single flat groupby replaces a per-city resample
+daily_df['week'] = daily_df['date'].dt.to_period('W-SUN').dt.end_time.dt.normalize()
+daily_df[static_columns] = daily_df[static_columns].astype('category')
+
 weekly_df = (
     daily_df
-    .set_index('date')
-    .groupby(static_columns)
-    .resample('W') # Resample to Weekly
+    .groupby(static_columns + ['week'], sort=False, observed=True)
     .agg(agg_rules) # Apply the specific math rules above
     .reset_index()
+    .rename(columns={'week': 'date'})
 )
 
 # Rename columns for clarity
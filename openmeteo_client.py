@@ -0,0 +1,90 @@
+import asyncio
+import aiohttp
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+import random
+import time
+
+# Shared Open-Meteo archive client used by Temperature/ and weather_data/ scripts:
+# pooled + cached session, header-driven rate limiting and retry with backoff.
+
+URL = "https://archive-api.open-meteo.com/v1/archive"
+MAX_CONCURRENT_REQUESTS = 8  # Caps in-flight API calls (replaces the fixed sleep)
+MAX_ATTEMPTS = 5  # Per request, before giving up on it
+KEEPALIVE_SECONDS = 60  # Longer than any backoff pause, so pooled connections survive retries
+CACHE_FILE = 'openmeteo_cache.sqlite'  # Responses are reused across reruns
+CACHE_EXPIRE_SECONDS = 60 * 60 * 24 * 30  # 30 days
+
+def retry_after_seconds(response):
+    """Numeric Retry-After header in seconds, or None if absent/unparseable."""
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):  # Missing, or sent as an HTTP date
+        return None
+
+def rate_limit_remaining(response):
+    """X-RateLimit-Remaining as an int, or None if absent/unparseable."""
+    try:
+        return int(response.headers['X-RateLimit-Remaining'])
+    except (KeyError, ValueError):
+        return None
+
+class RateLimiter:
+    """Reads the API's rate-limit headers and only pauses when they ask us to."""
+
+    def __init__(self, threshold=5, backoff=1.0):
+        self.threshold = threshold  # Start pausing below this many remaining calls
+        self.backoff = backoff      # Pause used when the server gives no Retry-After
+        self.remaining = 9999
+        self.next_allowed_ts = 0.0
+
+    async def wait(self):
+        delay = self.next_allowed_ts - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def update(self, response):
+        remaining = rate_limit_remaining(response)
+        self.remaining = 9999 if remaining is None else remaining
+        if response.status == 429 or self.remaining < self.threshold:
+            pause = retry_after_seconds(response) or self.backoff
+            self.next_allowed_ts = max(self.next_allowed_ts, time.monotonic() + pause)
+
+rate_limiter = RateLimiter()
+
+async def request_with_backoff(session, url, params, max_attempts=MAX_ATTEMPTS):
+    """GET url as JSON, retrying 429/5xx and network errors with jittered exponential backoff."""
+    for attempt in range(max_attempts):
+        await rate_limiter.wait()
+        retry_after = None
+        try:
+            async with session.get(url, params=params) as r:
+                if not getattr(r, 'from_cache', False):  # Cached headers say nothing about the API now
+                    rate_limiter.update(r)
+                if r.status != 429 and r.status < 500:
+                    r.raise_for_status()
+                    return await r.json()
+                error = f"HTTP {r.status}"
+                retry_after = retry_after_seconds(r)
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            error = repr(e)
+
+        if attempt + 1 < max_attempts:
+            # 1s, 2s, 4s, 8s... scaled by jitter so parallel retries don't line up
+            await asyncio.sleep(retry_after or (2 ** attempt) * random.uniform(0.5, 1.0))
+
+    raise RuntimeError(f"Giving up after {max_attempts} attempts: {error}")
+
+async def fetch_one(session, sem, params):
+    """GET one archive response, holding a semaphore slot while in flight."""
+    async with sem:
+        return await request_with_backoff(session, URL, params)
+
+def open_session():
+    """One pooled, disk-cached session for a whole run; use with `async with`."""
+    # Keep idle connections open between calls so each request skips the TCP+TLS handshake
+    connector = aiohttp.TCPConnector(limit=16, limit_per_host=8, keepalive_timeout=KEEPALIVE_SECONDS)
+    timeout = aiohttp.ClientTimeout(total=60, connect=5, sock_read=30)
+
+    # Repeat requests are answered from the on-disk cache
+    cache = SQLiteBackend(CACHE_FILE, expire_after=CACHE_EXPIRE_SECONDS, allowed_methods=('GET',))
+    return CachedSession(cache=cache, connector=connector, timeout=timeout)
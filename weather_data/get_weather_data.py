@@ -1,81 +1,146 @@
+import asyncio
+import aiohttp
+import os
+import sys
+import numpy as np
 import pandas as pd
-import requests
-import time
+
+# Shared Open-Meteo client (openmeteo_client.py) lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from openmeteo_client import MAX_CONCURRENT_REQUESTS, fetch_one, open_session
 
 # 1. SETUP & INPUT DATA
-input_filename = 'trends_checkpoint_2022_fixed.csv' # Replace for each year
-output_filename = 'trends-with_weather_2022.csv'
+input_dir = 'trends_out' # Parquet dataset written by the trends scraper
+trends_year = 2022 # Replace for each year
+output_filename = f'trends-with_weather_{trends_year}.csv'
 
-print(f"Loading {input_filename}...")
-df = pd.read_csv(input_filename)
+print(f"Loading {input_dir} ({trends_year})...")
+# Only the matching year= partition is read
+df = pd.read_parquet(input_dir, filters=[('year', '=', trends_year)])
 
 # Ensure date is datetime
 df['date'] = pd.to_datetime(df['date'])
 
+WEEK_EPOCH = np.datetime64('1970-01-04')  # A Sunday; Google Trends weeks run Sunday-Saturday
+
+def week_index(dates):
+    """Global Sun-Sat week number of each date (0 = week of 1970-01-04), via one numpy cast."""
+    days = dates.values.astype('datetime64[D]')
+    return (days - WEEK_EPOCH).astype('int64') // 7
+
+def week_start_year(week_idx):
+    """Calendar year of the Sunday that starts each week."""
+    starts = WEEK_EPOCH + np.asarray(week_idx) * 7
+    return starts.astype('datetime64[Y]').astype('int64') + 1970
+
 # CREATE JOIN KEYS
-# join on (Location + Year + Week Number).
-# This handles the "Fixed Date" vs "Real Date" issue perfectly.
-df['join_week'] = df['date'].dt.isocalendar().week.astype(int)
+# join on (Grid Cell + Week).
+# Each trends row is dated on the Sunday that starts its Google week, so one global
+# Sun-Sat week number (a single int64) identifies the week on both sides.
 df['join_year'] = df['year'].astype(int) 
+df['join_key'] = week_index(df['date'])
 
-# Identify unique locations/years to fetch (Optimization)
-unique_fetches = df[['location', 'latitude', 'longitude', 'join_year']].drop_duplicates()
+# Snap coordinates to Open-Meteo's 0.01° grid; nearby cities share one cell's weather
+df['lat_g'] = df['latitude'].round(2)
+df['lon_g'] = df['longitude'].round(2)
 
-print(f"Found {len(df)} rows. Need to fetch weather for {len(unique_fetches)} unique location-years.")
+# Identify unique grid cells/years to fetch (Optimization)
+unique_fetches = df[['lat_g', 'lon_g', 'join_year']].drop_duplicates()
+
+print(f"Found {len(df)} rows. Need to fetch weather for {len(unique_fetches)} unique grid cell-years.")
 
 # 2. DEFINE WEATHER FETCHING
 
-def get_yearly_weather(row):
-    year = int(row['join_year'])
-    lat = row['latitude']
-    lon = row['longitude']
-    location = row['location']
-    
-    # API Params
-    url = "https://archive-api.open-meteo.com/v1/archive"
+BATCH_SIZE = 100  # Locations sent per API call
+BATCH_TILE_DEGREES = 5  # Batches never span tiles, so a new city only reshuffles its own tile
+
+async def get_yearly_weather(session, sem, year, rows):
+    """
+    Fetches one year of daily weather for a batch of locations in a single API call.
+    A batch the API rejects is split in half and retried, down to single locations.
+    """
+    # API Params (comma-separated coordinates return one result per location)
     params = {
-        "latitude": lat,
-        "longitude": lon,
+        "latitude": ",".join(str(row['lat_g']) for row in rows),
+        "longitude": ",".join(str(row['lon_g']) for row in rows),
         "start_date": f"{year}-01-01",
-        "end_date": f"{year}-12-31",
-        "daily": ["temperature_2m_mean", "temperature_2m_max", "temperature_2m_min", "precipitation_sum"],
+        # Run past New Year so the last week starting in `year` is complete
+        "end_date": f"{year + 1}-01-06",
+        "daily": "temperature_2m_mean,temperature_2m_max,temperature_2m_min,precipitation_sum",
         "timezone": "auto",
         "temperature_unit": "celsius"
     }
 
     try:
-        r = requests.get(url, params=params)
-        r.raise_for_status()
-        data = r.json()
-        
-        # Create a mini DataFrame for this single location-year
-        daily = pd.DataFrame({
-            'date': data['daily']['time'],
-            'temp_mean': data['daily']['temperature_2m_mean'],
-            'temp_max': data['daily']['temperature_2m_max'],
-            'temp_min': data['daily']['temperature_2m_min'],
-            'precip': data['daily']['precipitation_sum']
-        })
-        
-        # Add metadata for merging later
-        daily['location'] = location
-        daily['join_year'] = year
-        return daily
+        print(f"Fetching weather for {len(rows)} locations ({year})")
+        data = await fetch_one(session, sem, params)
+        if isinstance(data, dict):  # A single location comes back as a bare object
+            data = [data]
+        if len(data) != len(rows):
+            raise ValueError(f"expected {len(rows)} locations in response, got {len(data)}")
+
+        chunks = []
+        for loc_data, row in zip(data, rows):
+            # Create a mini DataFrame for this single grid cell-year
+            daily = pd.DataFrame({
+                'date': loc_data['daily']['time'],
+                'temp_mean': loc_data['daily']['temperature_2m_mean'],
+                'temp_max': loc_data['daily']['temperature_2m_max'],
+                'temp_min': loc_data['daily']['temperature_2m_min'],
+                'precip': loc_data['daily']['precipitation_sum']
+            })
+
+            # Add metadata for merging later
+            daily['lat_g'] = row['lat_g']
+            daily['lon_g'] = row['lon_g']
+            daily['join_year'] = year
+            chunks.append(daily)
+
+        return pd.concat(chunks, ignore_index=True)
 
     except Exception as e:
-        print(f"Error fetching {location} ({year}): {e}")
-        return pd.DataFrame()
+        # Split only when this request itself was bad (rejected with a 4xx, or a malformed
+        # / short response). Retries running out on 429/5xx/network errors means the API
+        # needs a break, and splitting would multiply the calls against it.
+        bad_request = isinstance(e, (ValueError, KeyError)) or (
+            isinstance(e, aiohttp.ClientResponseError) and 400 <= e.status < 500 and e.status != 429
+        )
+        if len(rows) == 1 or not bad_request:
+            print(f"Error fetching batch of {len(rows)} locations ({year}), starting at "
+                  f"({rows[0]['lat_g']}, {rows[0]['lon_g']}): {e}")
+            return pd.DataFrame()
+
+        # Don't lose the whole batch to one bad location: retry each half separately
+        print(f"Batch of {len(rows)} locations failed ({year}): {e}. Splitting...")
+        mid = len(rows) // 2
+        halves = await asyncio.gather(
+            get_yearly_weather(session, sem, year, rows[:mid]),
+            get_yearly_weather(session, sem, year, rows[mid:])
+        )
+        return pd.concat(halves, ignore_index=True)
+
+async def fetch_all(batches):
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with open_session() as session:
+        return await asyncio.gather(*(get_yearly_weather(session, sem, year, rows) for year, rows in batches))
 
 # 3. FETCH & PROCESS WEATHER
 
-print("Starting Weather API calls...")
-weather_chunks = []
+# Group locations by year and map tile, and send up to BATCH_SIZE of them per request.
+# Sorted rows and tile-bounded batches keep each request's coordinate list (its cache key)
+# stable from run to run.
+tiles = [
+    unique_fetches['lat_g'] // BATCH_TILE_DEGREES,
+    unique_fetches['lon_g'] // BATCH_TILE_DEGREES
+]
+batches = []
+for (year, _, _), grp in unique_fetches.groupby(['join_year'] + tiles):
+    rows = grp.sort_values(['lat_g', 'lon_g']).to_dict('records')
+    for i in range(0, len(rows), BATCH_SIZE):
+        batches.append((int(year), rows[i:i + BATCH_SIZE]))
 
-for index, row in unique_fetches.iterrows():
-    print(f"Fetching weather for: {row['location']} ({row['join_year']})")
-    weather_chunk = get_yearly_weather(row)
-    weather_chunks.append(weather_chunk)
-    time.sleep(0.5) # Rate limiting
+print(f"Starting Weather API calls ({len(batches)} batched requests)...")
+weather_chunks = asyncio.run(fetch_all(batches))
 
 # Combine all daily weather data
 all_weather = pd.concat(weather_chunks, ignore_index=True)
@@ -84,11 +149,13 @@ all_weather['date'] = pd.to_datetime(all_weather['date'])
 # 4. AGGREGATE WEATHER TO WEEKLY
 print("Aggregating daily weather to weekly...")
 
-# Calculate Week Number for the weather data
-all_weather['join_week'] = all_weather['date'].dt.isocalendar().week.astype(int)
+# Calculate the Sun-Sat week key for the weather data
+all_weather['join_key'] = week_index(all_weather['date'])
+# Keep only weeks that start in the fetched year; the January tail belongs to the next year's fetch
+all_weather = all_weather[week_start_year(all_weather['join_key']) == all_weather['join_year']]
 
-# Group by [Location, Year, Week] and Aggregate
-weather_weekly = all_weather.groupby(['location', 'join_year', 'join_week']).agg({
+# Group by [Grid Cell, Week] and Aggregate
+weather_weekly = all_weather.groupby(['lat_g', 'lon_g', 'join_key']).agg({
     'temp_mean': 'mean',
     'temp_max': 'max',
     'temp_min': 'min',
@@ -97,7 +164,7 @@ weather_weekly = all_weather.groupby(['location', 'join_year', 'join_week']).agg
 
 # Rename columns
 weather_weekly.columns = [
-    'location', 'join_year', 'join_week', 
+    'lat_g', 'lon_g', 'join_key', 
     'avg_temp_c', 'max_temp_c', 'min_temp_c', 'total_precip_mm'
 ]
 
@@ -108,16 +175,16 @@ weather_weekly[cols_to_round] = weather_weekly[cols_to_round].round(2)
 # 5. MERGE BACK TO ORIGINAL DATA
 print("Merging weather data into original dataset...")
 
-# Left Join: Keep all original rows, match on Location + Year + Week
+# Left Join: Keep all original rows, match on Grid Cell + Week
 final_df = pd.merge(
     df, 
     weather_weekly, 
-    on=['location', 'join_year', 'join_week'], 
+    on=['lat_g', 'lon_g', 'join_key'], 
     how='left'
 )
 
 # Clean up helper columns
-final_df.drop(columns=['join_week', 'join_year'], inplace=True)
+final_df.drop(columns=['join_year', 'join_key', 'lat_g', 'lon_g'], inplace=True)
 
 # 6. SAVE
 final_df.to_csv(output_filename, index=False)